@@ -6,17 +6,64 @@ from qgis.core import (
     QgsProcessingParameterEnum, QgsProcessingParameterNumber,
     QgsCoordinateTransform, QgsCoordinateReferenceSystem, QgsProject,
 )
-from osgeo import gdal
+from osgeo import gdal, gdal_array
 from PIL import Image
 import numpy as np
-import zipfile, io, math
+import zipfile, io, math, os, threading, functools
+from concurrent.futures import ThreadPoolExecutor
+
+try:  # optional libjpeg-turbo binding (PyTurboJPEG); Pillow is used otherwise
+    from turbojpeg import TurboJPEG, TJPF_RGB, TJPF_GRAY, TJSAMP_420, TJSAMP_GRAY
+except ImportError:
+    TurboJPEG = None
 
 # Per-tile constraints
 MAX_PIXELS  = 1_000_000     # ≤1 MP
 MAX_BYTES   = 3 * 1024 * 1024  # ≤3 MB
 JPEG_QUALITY = 75           # non-progressive baseline
+SHRINK_QUALITIES = (65, 55, 45, 35)  # tried in order when a tile exceeds MAX_BYTES
 TILE_SIDE   = int(math.ceil(math.sqrt(MAX_PIXELS)))  # ~1000 px
 
+# KMZ packing: JPEG entries are stored, only doc.kml is deflated (6 ≈ size of 9 at a fraction of the CPU)
+KML_COMPRESSLEVEL = 6
+
+def _turbojpeg():
+    # One encoder per export; None when the module or libturbojpeg is unavailable
+    if TurboJPEG is None:
+        return None
+    try:
+        return TurboJPEG()
+    except Exception:
+        return None
+
+# Optional JIT for the fused stretch + CHW→HWC pass; NumPy is used otherwise.
+# numba is imported on first use, not at plugin load, so QGIS startup doesn't pay for it.
+_numba_lock = threading.Lock()
+_numba_kernel = []  # [kernel or None] once resolved
+
+def _chw_to_hwc_u8():
+    with _numba_lock:
+        if not _numba_kernel:
+            try:
+                from numba import njit
+            except ImportError:
+                _numba_kernel.append(None)
+            else:
+                @njit(nogil=True, cache=True)
+                def kernel(src, mn, scale, out):
+                    # Cast, stretch, clip and transpose in one pass, writing HWC rows contiguously
+                    for y in range(out.shape[0]):
+                        for x in range(out.shape[1]):
+                            for c in range(out.shape[2]):
+                                v = (src[c, y, x] - mn[c]) * scale[c]
+                                if v < 0.0:
+                                    v = 0.0
+                                elif v > 255.0:
+                                    v = 255.0
+                                out[y, x, c] = np.uint8(v)
+                _numba_kernel.append(kernel)
+        return _numba_kernel[0]
+
 DEVICES = ['eTrex (≤100 tiles)', 'GPSMAP (≤500 tiles)', 'Custom']
 DEVICE_LIMITS = [100, 500]
 
@@ -25,7 +72,22 @@ HELP_NOTE = (
     "  • eTrex, Monterra – up to ~100 tiles\n"
     "  • GPSMAP, Montana, Oregon – up to ~500 tiles\n"
     "Selecting eTrex or GPSMAP will generate the highest quality possible within the tile cap. "
-    "Choose 'Custom' to enter your own maximum tile count. Each tile is ≤1MP and ≤3MB, JPEG (non‑progressive, q=75)."
+    "Choose 'Custom' to enter your own maximum tile count. Each tile is ≤1MP and ≤3MB, JPEG (non‑progressive, q=75). "
+    "Tiles that would exceed 3MB are re-encoded at lower quality (down to q=35) before being downscaled."
+)
+
+KML_OVERLAY = (
+    "    <GroundOverlay>\n"
+    "      <Icon>\n"
+    "        <href>{f}</href>\n"
+    "      </Icon>\n"
+    "      <LatLonBox>\n"
+    "        <north>{n}</north>\n"
+    "        <south>{s}</south>\n"
+    "        <east>{e}</east>\n"
+    "        <west>{w}</west>\n"
+    "      </LatLonBox>\n"
+    "    </GroundOverlay>"
 )
 
 class ExportKMZAlgorithm(QgsProcessingAlgorithm):
@@ -87,129 +149,222 @@ class ExportKMZAlgorithm(QgsProcessingAlgorithm):
                           f"Original: {W}×{H} px → Resampled: {newW}×{newH} px. "
                           f"Tiling grid: {cols}×{rows} = {tiles} tiles.")
 
-        # Render resampled raster to memory
-        ds = gdal.Translate('', src_path, options=gdal.TranslateOptions(
-            width=newW, height=newH, resampleAlg='average', format='MEM'
-        ))
+        # Tiles are resampled from the source one at a time, straight to their final size
+        ds = gdal.Open(src_path)
 
         try:
-            arr = ds.ReadAsArray(0, 0, ds.RasterXSize, ds.RasterYSize)
             bands = ds.RasterCount
-            if bands == 1:
-                a = arr.astype('float32')
-                mn, mx = float(a.min()), float(a.max())
-                a = np.zeros_like(a) if mx <= mn else (a - mn) * (255.0 / (mx - mn))
-                rgb = np.stack([a, a, a]).astype('uint8')
-            else:
-                rgb = arr[:3] if arr.ndim == 3 else arr
-                if rgb.dtype != np.uint8:
-                    rgb = rgb.astype('float32')
-                    for i in range(rgb.shape[0]):
-                        mn, mx = float(rgb[i].min()), float(rgb[i].max())
-                        rgb[i] = 0 if mx <= mn else (rgb[i] - mn) * (255.0 / (mx - mn))
-                    rgb = rgb.astype('uint8')
-
-            from PIL import Image
-            base_img = Image.fromarray(rgb.transpose(1, 2, 0))
-
-            # WGS84 extents
+            gray = bands <= 2  # single band (or gray+alpha) is written as a grayscale JPEG of band 1
+            band_list = [1] if gray else list(range(1, min(bands, 3) + 1))
+
+            # Stretch with whole-raster min/max so tiles match at their seams; 8-bit RGB and gray+alpha are kept as-is.
+            # Approximate stats let GDAL use overviews or cached statistics instead of a full read.
+            stretch = None
+            if bands == 1 or ds.GetRasterBand(1).DataType != gdal.GDT_Byte:
+                mnmx = np.array([ds.GetRasterBand(b).ComputeRasterMinMax(True) for b in band_list], dtype=np.float32)
+                stretch = (mnmx[:, 0].copy(), mnmx[:, 1].copy())
+
+            img_w, img_h = newW, newH
+            sx, sy = W / float(newW), H / float(newH)  # resampled px → source px
+            native = abs(s - 1.0) < 1e-6 and newW == W and newH == H
+            if native:
+                feedback.pushInfo("Native resolution used, resampler bypassed.")
+
+            tile_w = int(math.ceil(img_w / float(cols)))
+            tile_h = int(math.ceil(img_h / float(rows)))
+
+            # Tile edges in pixels and in the layer CRS (flip Y), computed once for the whole grid
             extent = layer.extent()
+            x_edges = np.minimum(np.arange(cols + 1) * tile_w, img_w)
+            y_edges = np.minimum(np.arange(rows + 1) * tile_h, img_h)
+            xs_src = (extent.xMinimum() + extent.width() * (x_edges / float(img_w))).tolist()
+            ys_src = (extent.yMaximum() - extent.height() * (y_edges / float(img_h))).tolist()
+            x_edges, y_edges = x_edges.tolist(), y_edges.tolist()
+
+            # WGS84 position of every grid corner, so projected CRSes (e.g. UTM) place each
+            # tile where it is rather than interpolating inside the whole-extent bounding box
             wgs84  = QgsCoordinateReferenceSystem('EPSG:4326')
             ct     = QgsCoordinateTransform(layer.crs(), wgs84, QgsProject.instance())
-            rect   = ct.transformBoundingBox(extent)
-            north0, south0, east0, west0 = rect.yMaximum(), rect.yMinimum(), rect.xMaximum(), rect.xMinimum()
-            lon_span, lat_span = east0 - west0, north0 - south0
-
-            tile_w = int(math.ceil(base_img.width / float(cols)))
-            tile_h = int(math.ceil(base_img.height / float(rows)))
-
-            overlays = []  # (fname, bytes, west, east, south, north)
-
-            def jpg75_nonprog(img):
+            corners = [[ct.transform(x, y) for x in xs_src] for y in ys_src]
+            lon = [[p.x() for p in row] for row in corners]
+            lat = [[p.y() for p in row] for row in corners]
+
+            # Bind the keyword arguments that are fixed for the whole export (pixel format,
+            # subsampling, flags); only the tile and quality vary per call
+            tj = _turbojpeg()
+            if tj is not None:
+                tj_encode = functools.partial(
+                    tj.encode, pixel_format=TJPF_GRAY if gray else TJPF_RGB,
+                    jpeg_subsample=TJSAMP_GRAY if gray else TJSAMP_420, flags=0
+                )
+
+            def jpg_nonprog(tile, quality=JPEG_QUALITY):
+                if tj is not None:
+                    tile = np.ascontiguousarray(tile)
+                    return tj_encode(tile[:, :, np.newaxis] if gray else tile, quality=quality)
+                img = Image.fromarray(tile)
+                mode = 'L' if gray else 'RGB'
+                if img.mode != mode:
+                    img = img.convert(mode)
+                opts = {} if gray else {'subsampling': 2}  # 4:2:0
                 buf = io.BytesIO()
-                img.convert('RGB').save(buf, 'JPEG', quality=JPEG_QUALITY, optimize=True, progressive=False)
+                img.save(buf, 'JPEG', quality=quality, optimize=False, progressive=False, **opts)
+                if buf.tell() > MAX_BYTES:
+                    # Optimized Huffman tables cost a second pass; only pay it when over the cap
+                    buf = io.BytesIO()
+                    img.save(buf, 'JPEG', quality=quality, optimize=True, progressive=False, **opts)
                 return buf.getvalue()
 
+            local = threading.local()
+
+            def source():
+                # One source handle per worker thread (GDAL datasets must not be shared across
+                # threads), reused for all of its tiles instead of reopening the file per tile
+                if getattr(local, 'ds', None) is None:
+                    local.ds = gdal.Open(src_path)
+                return local.ds
+
+            src_dtype = gdal_array.GDALTypeCodeToNumericTypeCode(ds.GetRasterBand(1).DataType)
+
+            def scratch(name, shape, dtype):
+                # Full-tile buffer per worker thread; each tile reads into / writes a view of it
+                buf = getattr(local, name, None)
+                if buf is None:
+                    buf = np.empty(shape, dtype=dtype)
+                    setattr(local, name, buf)
+                return buf
+
+            def render(x0, y0, x1, y1, out_w, out_h):
+                raw = scratch('raw', (len(band_list), tile_h, tile_w), src_dtype)[:, :out_h, :out_w]
+                if native and (out_w, out_h) == (x1 - x0, y1 - y0):
+                    # 1:1 window, read it straight from the source
+                    src = source()
+                    for i, b in enumerate(band_list):
+                        src.GetRasterBand(b).ReadAsArray(x0, y0, out_w, out_h, buf_obj=raw[i])
+                else:
+                    # One GDAL Lanczos pass from the source window to out_w×out_h
+                    t = gdal.Translate('', source(), options=gdal.TranslateOptions(
+                        srcWin=[x0*sx, y0*sy, (x1-x0)*sx, (y1-y0)*sy], width=out_w, height=out_h,
+                        bandList=band_list, resampleAlg='lanczos', format='MEM'
+                    ))
+                    for i in range(len(band_list)):
+                        t.GetRasterBand(i + 1).ReadAsArray(buf_obj=raw[i])
+                    t = None
+                out = scratch('hwc', (tile_h, tile_w, len(band_list)), np.uint8)[:out_h, :out_w]
+                if stretch is not None:
+                    f32 = scratch('f32', (tile_h, tile_w), np.float32)[:out_h, :out_w]
+                    self._stretch_u8(raw, *stretch, out=out, f32=f32)
+                else:
+                    np.copyto(out, raw.transpose(1, 2, 0))  # 8-bit RGB, no stretch
+                return out[:, :, 0] if gray else out
+
+            # Tile jobs: (idx, x0, y0, x1, y1, (west, east, south, north))
+            jobs = []
             idx = 0
             for r in range(rows):
                 for c in range(cols):
-                    x0, y0 = c*tile_w, r*tile_h
-                    x1, y1 = min(base_img.width, x0+tile_w), min(base_img.height, y0+tile_h)
+                    x0, x1, y0, y1 = x_edges[c], x_edges[c+1], y_edges[r], y_edges[r+1]
                     if x0 >= x1 or y0 >= y1:
                         idx += 1; continue
 
-                    tile = base_img.crop((x0, y0, x1, y1))
+                    # LatLonBox edges average their two corners. Only edge-adjacent tiles share an edge;
+                    # on a grid rotated against lon/lat (e.g. UTM), rows get slightly different east/west
+                    # edges, leaving small gaps/overlaps at corners that an axis-aligned box can't avoid
+                    bounds = ((lon[r][c] + lon[r+1][c]) / 2.0, (lon[r][c+1] + lon[r+1][c+1]) / 2.0,
+                              (lat[r+1][c] + lat[r+1][c+1]) / 2.0, (lat[r][c] + lat[r][c+1]) / 2.0)
+                    jobs.append((idx, x0, y0, x1, y1, bounds))
+                    idx += 1
 
-                    # Enforce 1MP per tile
-                    tw, th = tile.size
-                    scale_mp = min(1.0, math.sqrt(MAX_PIXELS / float(max(1, tw*th))))
-                    if scale_mp < 1.0:
-                        tile = tile.resize((max(1,int(tw*scale_mp)), max(1,int(th*scale_mp))), Image.LANCZOS)
+            # Encoders release the GIL, so tiles scale across a thread pool
+            lock = threading.Lock()
+            done = [0]
 
-                    jpg = jpg75_nonprog(tile)
-                    while len(jpg) > MAX_BYTES and (tile.width*tile.height) > 64*64:
-                        tile = tile.resize((max(1,int(tile.width*0.9)), max(1,int(tile.height*0.9))), Image.LANCZOS)
-                        jpg = jpg75_nonprog(tile)
+            def encode_one(job):
+                idx, x0, y0, x1, y1, bounds = job
 
-                    # width/height in degrees
-                    lon_span = east0 - west0
-                    lat_span = north0 - south0
+                # Enforce 1MP per tile
+                tw, th = x1 - x0, y1 - y0
+                scale_mp = min(1.0, math.sqrt(MAX_PIXELS / float(max(1, tw*th))))
+                tw, th = max(1, int(tw*scale_mp)), max(1, int(th*scale_mp))
 
-                    twest = west0 + lon_span * (x0 / float(base_img.width))
-                    teast = west0 + lon_span * (x1 / float(base_img.width))
-                    tnorth = north0 - lat_span * (y0 / float(base_img.height))  # flip Y
-                    tsouth = north0 - lat_span * (y1 / float(base_img.height))  # flip Y
+                tile = render(x0, y0, x1, y1, tw, th)
+                jpg = jpg_nonprog(tile)
 
-                    overlays.append((f"image_{idx:03d}.jpg", jpg, twest, teast, tsouth, tnorth))
-                    idx += 1
+                # Over the byte cap: step quality down first, downscale only as a last resort
+                for q in SHRINK_QUALITIES:
+                    if len(jpg) <= MAX_BYTES:
+                        break
+                    jpg = jpg_nonprog(tile, q)
+                while len(jpg) > MAX_BYTES and tw*th > 64*64:
+                    tw, th = max(1, int(tw*0.9)), max(1, int(th*0.9))
+                    jpg = jpg_nonprog(render(x0, y0, x1, y1, tw, th), SHRINK_QUALITIES[-1])
+
+                with lock:
+                    done[0] += 1
+                    feedback.setProgress(100.0 * done[0] / max(1, len(jobs)))
+                return (f"image_{idx:03d}.jpg", jpg) + bounds
+
+            with ThreadPoolExecutor(max_workers=os.cpu_count() or 1) as ex:
+                # (fname, bytes, west, east, south, north), in tile order
+                overlays = list(ex.map(encode_one, jobs))
 
-            # Build KML
+            # Build KML: one formatted string per overlay
             layer_name = layer.name()
-            parts = [
-                "<?xml version='1.0' encoding='UTF-8'?>",
-                "<kml xmlns='http://www.opengis.net/kml/2.2'>",
-                "  <Document>",
-                f"    <name>{layer_name}</name>",
+            header = (
+                "<?xml version='1.0' encoding='UTF-8'?>\n"
+                "<kml xmlns='http://www.opengis.net/kml/2.2'>\n"
+                "  <Document>\n"
+                f"    <name>{layer_name}</name>\n"
                 f"    <description>QGIS GarminDeviceExport by Chris.Evans@gmail.com – {tiles} tiles</description>"
-
-            ]
-            for fname, data, w, e, s, n in overlays:
-                parts += [
-                    "    <GroundOverlay>",
-                    "      <Icon>",
-                    f"        <href>{fname}</href>",
-                    "      </Icon>",
-                    "      <LatLonBox>",
-                    f"        <north>{n}</north>",
-                    f"        <south>{s}</south>",
-                    f"        <east>{e}</east>",
-                    f"        <west>{w}</west>",
-                    "      </LatLonBox>",
-                    "    </GroundOverlay>",
-                ]
-            parts += ["  </Document>", "</kml>"]
-            kml = "\n".join(parts)
-
-            with zipfile.ZipFile(out_path, 'w', compression=zipfile.ZIP_DEFLATED, compresslevel=9) as z:
-                z.writestr('doc.kml', kml)
+            )
+            kml = "\n".join(
+                [header]
+                + [KML_OVERLAY.format(f=fname, n=n, s=s_, e=e, w=w) for fname, _, w, e, s_, n in overlays]
+                + ["  </Document>\n</kml>"]
+            )
+
+            # JPEGs are already entropy-coded, so only the KML is deflated.
+            # ZipFile seeks back to patch each local header, which flushes the buffer per entry;
+            # a 4 MiB buffer still saves about one write() per entry over the 8 KiB default.
+            with open(out_path, 'wb', buffering=4 * 1024 * 1024) as f, \
+                    zipfile.ZipFile(f, 'w', compression=zipfile.ZIP_STORED) as z:
+                z.writestr('doc.kml', kml, compress_type=zipfile.ZIP_DEFLATED, compresslevel=KML_COMPRESSLEVEL)
                 for fname, data, *_ in overlays:
-                    z.writestr(fname, data)
+                    z.writestr(fname, data, compress_type=zipfile.ZIP_STORED)
 
             return { self.OUTPUT: out_path }
 
         finally:
             ds = None
 
+    @staticmethod
+    def _stretch_u8(chw, mn, mx, out=None, f32=None):
+        # Per-band min/max stretch of a (bands, H, W) array to (H, W, bands) uint8; mn/mx are per band.
+        # out / f32 are optional caller-owned (H, W, bands) uint8 and (H, W) float32 buffers
+        scale = (255.0 / np.where(mx > mn, mx - mn, 1.0)).astype(np.float32)
+        if out is None:
+            out = np.empty(chw.shape[1:] + chw.shape[:1], dtype=np.uint8)
+        kernel = _chw_to_hwc_u8()
+        if kernel is not None:
+            kernel(chw, mn, scale, out)
+            return out
+        # NumPy fallback: one float32 band of scratch, reused, instead of a float copy of every band
+        if f32 is None:
+            f32 = np.empty(chw.shape[1:], dtype=np.float32)
+        for i in range(chw.shape[0]):
+            np.subtract(chw[i], mn[i], out=f32, dtype=np.float32)
+            np.multiply(f32, scale[i], out=f32)
+            np.clip(f32, 0, 255, out=f32)
+            out[:, :, i] = f32
+        return out
+
     @staticmethod
     def _scale_for_tile_cap(W, H, tile_side, cap):
-        # Largest s in (0,1] so that ceil(W*s/t)*ceil(H*s/t) <= cap
-        lo, hi = 0.0, 1.0
-        for _ in range(40):
-            mid = (lo + hi) / 2.0
-            cols = int(math.ceil((W * mid) / float(tile_side)))
-            rows = int(math.ceil((H * mid) / float(tile_side)))
-            if max(1, cols) * max(1, rows) <= cap:
-                lo = mid
-            else:
-                hi = mid
-        return max(1e-6, lo)
+        # Largest s in (0,1] so that ceil(W*s/t)*ceil(H*s/t) <= cap.
+        # A cols×rows grid fits while s <= min(cols*t/W, rows*t/H), and for a given
+        # cols the best rows is cap // cols; more than ceil(W/t) cols never helps at s <= 1.
+        best = 0.0
+        for cols in range(1, min(cap, int(math.ceil(W / float(tile_side)))) + 1):
+            rows = cap // cols
+            best = max(best, min(cols * tile_side / float(W), rows * tile_side / float(H)))
+        return max(1e-6, min(1.0, best))